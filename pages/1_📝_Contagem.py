@@ -3,10 +3,16 @@ import pandas as pd
 import os
 from datetime import datetime
 
+from v2_flask.sites import get_site_dir, list_sites
+from v2_flask.storage import write_snapshot
+
 # Configuração da página
 st.set_page_config(page_title="Contagem de Estoque", layout="wide")
 
-FILE_PATH = 'data/Base_estoque.xlsx'
+# Cada local tem sua própria pasta de dados
+site = st.sidebar.selectbox("Local", list_sites())
+SITE_DIR = get_site_dir(site)
+FILE_PATH = os.path.join(SITE_DIR, 'Base_estoque.xlsx')
 
 def load_data():
     if os.path.exists(FILE_PATH):
@@ -57,10 +63,9 @@ def save_data(df, selected_date):
              df['Planejamento de Produção '] = df['Estoque Minimo'] - df['TOTAL']
         
         # Salvar no arquivo com o nome da data selecionada
+        # Gravação atômica, com trava por data compartilhada com a versão Flask
         date_str = selected_date.strftime("%d-%m-%Y")
-        file_name = f"data/{date_str}_contagem.xlsx"
-        
-        df.to_excel(file_name, index=False)
+        file_name, _ = write_snapshot(SITE_DIR, date_str, df)
         st.success(f"Contagem registrada com sucesso em {file_name}!")
         return True
     except Exception as e:
@@ -72,6 +77,11 @@ st.title("📦 Sistema de Contagem de Estoque")
 # Campo para inserir a data
 selected_date = st.date_input("Data da Contagem", datetime.now(), format="DD/MM/YYYY")
 
+# Recarregar a base ao trocar de local
+if st.session_state.get('site') != site:
+    st.session_state.site = site
+    st.session_state.pop('df_estoque', None)
+
 if 'df_estoque' not in st.session_state:
     loaded_df = load_data()
     if loaded_df is not None:
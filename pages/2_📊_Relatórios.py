@@ -4,13 +4,18 @@ import os
 import glob
 from datetime import datetime
 
+from v2_flask.sites import get_archive_dir, get_site_dir, list_sites
+
 st.set_page_config(page_title="Relatório de Estoque", layout="wide")
 
 st.title("📊 Relatório de Estoque e Planejamento")
 
 # Função para listar arquivos de contagem
-def list_count_files():
-    files = glob.glob("data/*_contagem.xlsx")
+def list_count_files(site_dir):
+    # Inclui as contagens movidas para o arquivo pela compactação;
+    # as da pasta principal vêm por último e prevalecem na mesma data
+    files = glob.glob(os.path.join(get_archive_dir(site_dir), "*_contagem.xlsx"))
+    files += glob.glob(os.path.join(site_dir, "*_contagem.xlsx"))
     file_data = []
     for f in files:
         try:
@@ -26,7 +31,8 @@ def list_count_files():
     file_data.sort(key=lambda x: x["date"], reverse=True)
     return file_data
 
-files = list_count_files()
+site = st.sidebar.selectbox("Local", list_sites())
+files = list_count_files(get_site_dir(site))
 
 if not files:
     st.warning("Nenhum arquivo de contagem encontrado.")
@@ -1,26 +1,171 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_file
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_file, session
 from io import BytesIO
 import pandas as pd
 import os
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import glob
 import json
 
+from compaction import load_rollup_points
+from sites import DEFAULT_SITE, get_archive_dir, get_rollup_dir, get_site_dir, is_valid_site, list_sites
+from storage import get_data_version, write_snapshot
+
 app = Flask(__name__)
 app.secret_key = 'supersecretkey'  # Needed for flash messages
 
-# Define data directory relative to this file
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_DIR = os.path.join(BASE_DIR, '../data')
+# Threads used to build the consolidated report across sites
+SITE_WORKERS = int(os.environ.get('SITE_WORKERS', 4))
+
+def get_current_site():
+    """Return the site chosen with ``?site=`` (remembered in the session)."""
+    site = request.args.get('site')
+    if site and is_valid_site(site):
+        session['site'] = site
+        return site
+    site = session.get('site')
+    if site and is_valid_site(site):
+        return site
+    return DEFAULT_SITE
+
+@app.context_processor
+def inject_sites():
+    return {'sites': list_sites(), 'current_site': get_current_site()}
+
+def get_base_file_path(site=DEFAULT_SITE):
+    return os.path.join(get_site_dir(site), 'Base_estoque.xlsx')
+
+def list_count_files(site=DEFAULT_SITE):
+    """Return the site's count snapshots, most recent first.
+
+    Snapshots moved to the archive by the compaction job are included
+    (``archived``); a live file wins if a date is in both.
+    """
+    site_dir = get_site_dir(site)
+    files = glob.glob(os.path.join(get_archive_dir(site_dir), '*_contagem.xlsx'))
+    files += glob.glob(os.path.join(site_dir, '*_contagem.xlsx'))
+    options_by_date = {}
+    for f in files:
+        try:
+            filename = os.path.basename(f)
+            date_str_part = filename.split('_')[0]
+            date_obj = datetime.strptime(date_str_part, '%d-%m-%Y')
+            options_by_date[date_str_part] = {
+                'filename': filename,
+                'path': f,
+                'archived': os.path.dirname(f) != site_dir,
+                'date': date_obj,
+                'date_str': date_obj.strftime('%d/%m/%Y'),
+                'raw_date': date_str_part
+            }
+        except Exception:
+            continue
+
+    file_options = list(options_by_date.values())
+    file_options.sort(key=lambda x: x['date'], reverse=True)
+    return file_options
+
+# Fields sent to the count form for each product (Grupo is implied by the request)
+COUNT_FIELDS = ['Câmara', 'Freezer 01', 'Freezer 02']
+COUNT_VIEW_FIELDS = ['Produto'] + COUNT_FIELDS + ['Estoque Minimo']
+
+# Per-site caches, each entry reused until its files change on disk
+_base_cache = {}
+_history_cache = {}
+_latest_cache = {}
+
+# One lock per (site, cache) so concurrent misses on the same site build the
+# entry once, while other sites are never blocked
+_site_locks = {}
+_site_locks_guard = threading.Lock()
+
+def _site_lock(site, cache_name):
+    with _site_locks_guard:
+        return _site_locks.setdefault((site, cache_name), threading.Lock())
 
-def get_base_file_path():
-    return os.path.join(DATA_DIR, 'Base_estoque.xlsx')
+def load_count_base(site=DEFAULT_SITE):
+    """Return the site's base catalogue prepared for a new count (counts zeroed).
 
-def get_count_file_path(date_str):
-    return os.path.join(DATA_DIR, f'{date_str}_contagem.xlsx')
+    Also returns a token identifying this version of the catalogue; row ids
+    sent to the count form are only valid for the same token.
+    """
+    with _site_lock(site, 'base'):
+        return _load_count_base(site)
 
-def get_historical_data():
-    files = glob.glob(os.path.join(DATA_DIR, '*_contagem.xlsx'))
+def _load_count_base(site):
+    base_path = get_base_file_path(site)
+    stat = os.stat(base_path)
+    token = f'{stat.st_mtime_ns}-{stat.st_size}'
+    cached = _base_cache.get(site)
+    if cached and cached['path'] == base_path and cached['token'] == token:
+        return cached['df'], token
+
+    df = pd.read_excel(base_path)
+
+    # Clean and initialize
+    cols_to_numeric = ['Câmara', 'Freezer 01', 'Freezer 02', 'TOTAL', 'Estoque Minimo', 'Planejamento de Produção ']
+    for col in cols_to_numeric:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+
+    # Zero out counts for new count
+    cols_to_zero = ['Câmara', 'Freezer 01', 'Freezer 02', 'TOTAL']
+    for col in cols_to_zero:
+        if col in df.columns:
+            df[col] = 0
+
+    # Initial Planning calculation
+    if 'Planejamento de Produção ' in df.columns and 'Estoque Minimo' in df.columns:
+        df['Planejamento de Produção '] = df['Estoque Minimo'] - df['TOTAL']
+
+    if 'Unnamed: 8' in df.columns:
+        df = df.drop(columns=['Unnamed: 8'])
+
+    df = df.reset_index(drop=True)
+
+    _base_cache[site] = {'path': base_path, 'token': token, 'df': df}
+    return df, token
+
+def _history_signature(site_dir):
+    files = glob.glob(os.path.join(site_dir, '*_contagem.xlsx'))
+    files += glob.glob(os.path.join(get_rollup_dir(site_dir), '*_historico.csv'))
+    signature = [('version', get_data_version(site_dir))]
+    for f in files:
+        try:
+            signature.append((f, os.path.getmtime(f)))
+        except OSError:
+            continue
+    return tuple(sorted(signature))
+
+# Rebuilds tried when saves keep committing while the history is read
+HISTORY_BUILD_ATTEMPTS = 3
+
+def get_historical_data(site=DEFAULT_SITE):
+    """Return the site's history, tagged with the data version it was read at.
+
+    The view is only accepted (and cached) if no save committed while it was
+    being read; otherwise it is rebuilt, and after the last attempt it is
+    returned uncached, tagged with the version it started from.
+    """
+    site_dir = get_site_dir(site)
+    with _site_lock(site, 'history'):
+        for _ in range(HISTORY_BUILD_ATTEMPTS):
+            signature = _history_signature(site_dir)
+            cached = _history_cache.get(site)
+            if cached and cached[0] == signature:
+                return cached[1]
+
+            history = _build_historical_data(site_dir)
+            history['version'] = dict(signature)['version']
+            if _history_signature(site_dir) == signature:
+                _history_cache[site] = (signature, history)
+                return history
+        return history
+
+def _build_historical_data(site_dir):
+
+    files = glob.glob(os.path.join(site_dir, '*_contagem.xlsx'))
     data_points = []
     
     # Track all unique (product, group) pairs
@@ -57,8 +202,18 @@ def get_historical_data():
                 'groups': group_totals,
                 'products': current_products
             })
-        except Exception:
+        except Exception as e:
+            app.logger.warning('Ignorando %s no histórico: %s', f, e)
+            continue
+
+    # Older counts come from the compacted roll-ups; a live snapshot wins if
+    # a date is in both (e.g. an interrupted compaction)
+    live_dates = {dp['date_str'] for dp in data_points}
+    for dp in load_rollup_points(site_dir):
+        if dp['date_str'] in live_dates:
             continue
+        all_product_groups.update(dp['products'].keys())
+        data_points.append(dp)
     
     data_points.sort(key=lambda x: x['date'])
     
@@ -91,6 +246,47 @@ def get_historical_data():
         'products': products_series
     }
 
+def get_latest_summary(site=DEFAULT_SITE):
+    """Return the headline metrics of the site's most recent count, or None."""
+    with _site_lock(site, 'latest'):
+        return _load_latest_summary(site)
+
+def _load_latest_summary(site):
+    file_options = list_count_files(site)
+    if not file_options:
+        return None
+
+    latest = file_options[0]
+    file_path = latest['path']
+    mtime = os.path.getmtime(file_path)
+    cached = _latest_cache.get(site)
+    if cached and cached[0] == (file_path, mtime):
+        return cached[1]
+
+    df = pd.read_excel(file_path)
+    prod_col = 'Planejamento de Produção '
+    if 'TOTAL' in df.columns:
+        df['TOTAL'] = pd.to_numeric(df['TOTAL'], errors='coerce').fillna(0)
+    summary = {
+        'date_str': latest['date_str'],
+        'raw_date': latest['raw_date'],
+        'total_items': len(df),
+        'total_stock': float(df['TOTAL'].sum()) if 'TOTAL' in df.columns else 0,
+        'items_to_produce': int((df[prod_col] > 0).sum()) if prod_col in df.columns else 0
+    }
+    _latest_cache[site] = ((file_path, mtime), summary)
+    return summary
+
+def get_site_report(site):
+    """Latest count and total stock history of one site, for the consolidated view."""
+    history = get_historical_data(site)
+    totals = [sum(g['data'][i] for g in history['groups']) for i in range(len(history['dates']))]
+    return {
+        'site': site,
+        'latest': get_latest_summary(site),
+        'history': {'dates': history['dates'], 'totals': totals}
+    }
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -102,18 +298,32 @@ def count():
             data = request.json
             date_str = data.get('date')
             items = data.get('items')
+            site = data.get('site') or get_current_site()
 
             if not date_str or not items:
                 return jsonify({'success': False, 'message': 'Dados inválidos.'}), 400
 
-            # Convert items back to DataFrame
-            df = pd.DataFrame(items)
-            
-            # Ensure numeric columns
-            cols_to_numeric = ['Câmara', 'Freezer 01', 'Freezer 02', 'TOTAL', 'Estoque Minimo', 'Planejamento de Produção ']
-            for col in cols_to_numeric:
-                if col in df.columns:
-                    df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+            if not is_valid_site(site):
+                return jsonify({'success': False, 'message': f'Local desconhecido: {site}'}), 400
+
+            # Rebuild the full count from the base catalogue; the client only
+            # sends the rows (by id) of the groups it has loaded
+            base_df, token = load_count_base(site)
+            if data.get('token') != token:
+                return jsonify({'success': False, 'message': 'O arquivo base foi alterado durante a contagem. Recarregue a página e refaça a contagem.'}), 409
+            df = base_df.copy()
+
+            counts = pd.DataFrame(items)
+            if 'id' not in counts.columns:
+                return jsonify({'success': False, 'message': 'Dados inválidos.'}), 400
+            counts['id'] = pd.to_numeric(counts['id'], errors='coerce')
+            counts = counts.dropna(subset=['id'])
+            counts['id'] = counts['id'].astype(int)
+            counts = counts[counts['id'].isin(df.index)].drop_duplicates('id', keep='last').set_index('id')
+
+            for col in COUNT_FIELDS:
+                if col in df.columns and col in counts.columns:
+                    df.loc[counts.index, col] = pd.to_numeric(counts[col], errors='coerce').fillna(0)
 
             # Calculate Total and Planning
             cols_to_sum = ['Câmara', 'Freezer 01', 'Freezer 02']
@@ -133,60 +343,81 @@ def count():
             except ValueError:
                 return jsonify({'success': False, 'message': 'Formato de data inválido.'}), 400
 
-            file_path = get_count_file_path(formatted_date)
-            df.to_excel(file_path, index=False)
+            # Written to a temp file and renamed under the date's lock
+            write_snapshot(get_site_dir(site), formatted_date, df)
+            _history_cache.pop(site, None)
+            _latest_cache.pop(site, None)
 
             return jsonify({'success': True, 'message': f'Contagem salva com sucesso em {formatted_date}_contagem.xlsx!'})
 
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)}), 500
 
-    # GET request: Load base data
-    base_path = get_base_file_path()
+    # GET request: render only the group list; products are fetched per group
+    site = get_current_site()
+    base_path = get_base_file_path(site)
     if not os.path.exists(base_path):
         flash(f'Arquivo base não encontrado em {base_path}', 'error')
         return redirect(url_for('index'))
 
     try:
-        df = pd.read_excel(base_path)
-        
-        # Prepare data for frontend
-        # Clean and initialize
-        cols_to_numeric = ['Câmara', 'Freezer 01', 'Freezer 02', 'TOTAL', 'Estoque Minimo', 'Planejamento de Produção ']
-        for col in cols_to_numeric:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-        
-        # Zero out counts for new count
-        cols_to_zero = ['Câmara', 'Freezer 01', 'Freezer 02', 'TOTAL']
-        for col in cols_to_zero:
-            if col in df.columns:
-                df[col] = 0
-        
-        # Initial Planning calculation
-        if 'Planejamento de Produção ' in df.columns and 'Estoque Minimo' in df.columns:
-            df['Planejamento de Produção '] = df['Estoque Minimo'] - df['TOTAL']
-
-        if 'Unnamed: 8' in df.columns:
-            df = df.drop(columns=['Unnamed: 8'])
+        df, token = load_count_base(site)
 
         # Get unique groups
         groups = sorted(df['Grupo'].dropna().unique().tolist()) if 'Grupo' in df.columns else []
         
-        # Convert to records for JS
-        records = df.to_dict('records')
-        
-        return render_template('count.html', groups=groups, data=records, today=datetime.now().strftime('%Y-%m-%d'))
+        return render_template('count.html', site=site, groups=groups, token=token, today=datetime.now().strftime('%Y-%m-%d'))
 
     except Exception as e:
         flash(f'Erro ao ler arquivo base: {str(e)}', 'error')
         return redirect(url_for('index'))
 
+@app.route('/api/count/group')
+def count_group():
+    group = request.args.get('group')
+    if not group:
+        return jsonify({'success': False, 'message': 'Grupo não informado.'}), 400
+
+    site = get_current_site()
+    base_path = get_base_file_path(site)
+    if not os.path.exists(base_path):
+        return jsonify({'success': False, 'message': f'Arquivo base não encontrado em {base_path}'}), 404
+
+    try:
+        df, token = load_count_base(site)
+        if 'Grupo' not in df.columns:
+            return jsonify({'success': False, 'message': 'Arquivo base sem coluna Grupo.'}), 400
+
+        group_df = df[df['Grupo'].astype(str) == group]
+        cols = [c for c in COUNT_VIEW_FIELDS if c in group_df.columns]
+        group_df = group_df[cols].copy()
+        if 'Produto' in group_df.columns:
+            group_df['Produto'] = group_df['Produto'].fillna('').astype(str)
+
+        items = []
+        for idx, record in zip(group_df.index, group_df.to_dict('records')):
+            record['id'] = int(idx)
+            items.append(record)
+
+        return jsonify({'success': True, 'group': group, 'token': token, 'items': items})
+
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/history')
+def history_api():
+    history = get_historical_data(get_current_site())
+    return jsonify(history)
+
 @app.route('/download/<date_str>')
 def download_report(date_str):
     # date_str is expected to be DD-MM-YYYY as in the filename
     filename = f'{date_str}_contagem.xlsx'
-    file_path = os.path.join(DATA_DIR, filename)
+    site_dir = get_site_dir(get_current_site())
+    file_path = os.path.join(site_dir, filename)
+    if not os.path.exists(file_path):
+        # Snapshots moved out by the compaction job
+        file_path = os.path.join(get_archive_dir(site_dir), filename)
     
     if not os.path.exists(file_path):
         flash('Arquivo não encontrado.', 'error')
@@ -227,24 +458,8 @@ def download_report(date_str):
 
 @app.route('/reports')
 def reports():
-    # List files
-    files = glob.glob(os.path.join(DATA_DIR, '*_contagem.xlsx'))
-    file_options = []
-    for f in files:
-        try:
-            filename = os.path.basename(f)
-            date_str_part = filename.split('_')[0]
-            date_obj = datetime.strptime(date_str_part, '%d-%m-%Y')
-            file_options.append({
-                'filename': filename,
-                'date': date_obj,
-                'date_str': date_obj.strftime('%d/%m/%Y'),
-                'raw_date': date_str_part
-            })
-        except Exception:
-            continue
-    
-    file_options.sort(key=lambda x: x['date'], reverse=True)
+    site = get_current_site()
+    file_options = list_count_files(site)
     
     selected_date = request.args.get('date')
     selected_file = None
@@ -262,7 +477,7 @@ def reports():
     report_data = None
     if selected_file:
         try:
-            file_path = os.path.join(DATA_DIR, selected_file['filename'])
+            file_path = selected_file['path']
             df = pd.read_excel(file_path)
             
             # Calculate metrics
@@ -304,8 +519,43 @@ def reports():
         except Exception as e:
             flash(f'Erro ao carregar relatório: {str(e)}', 'error')
 
-    history = get_historical_data()
-    return render_template('reports.html', file_options=file_options, selected_file=selected_file, report_data=report_data, history=history)
+    history = get_historical_data(site)
+    return render_template('reports.html', site=site, file_options=file_options, selected_file=selected_file, report_data=report_data, history=history)
+
+@app.route('/reports/consolidated')
+def consolidated_report():
+    sites = list_sites()
+
+    # One task per site on a small thread pool. Spreadsheet parsing holds the
+    # GIL, so cold builds are not truly parallel; what this buys is that each
+    # site only waits on its own cache locks and warm sites return at once
+    site_reports = []
+    with ThreadPoolExecutor(max_workers=max(1, min(SITE_WORKERS, len(sites)))) as executor:
+        futures = {site: executor.submit(get_site_report, site) for site in sites}
+        for site in sites:
+            try:
+                site_reports.append(futures[site].result())
+            except Exception as e:
+                flash(f'Erro ao carregar o local {site}: {str(e)}', 'error')
+
+    totals = {'total_items': 0, 'total_stock': 0, 'items_to_produce': 0}
+    for report in site_reports:
+        if report['latest']:
+            for key in totals:
+                totals[key] += report['latest'][key]
+
+    # Align every site's history on the union of dates
+    all_dates = set()
+    for report in site_reports:
+        all_dates.update(report['history']['dates'])
+    dates = sorted(all_dates, key=lambda d: datetime.strptime(d, '%d-%m-%Y'))
+    series = []
+    for report in site_reports:
+        by_date = dict(zip(report['history']['dates'], report['history']['totals']))
+        series.append({'label': report['site'], 'data': [by_date.get(d) for d in dates]})
+
+    return render_template('consolidated.html', site_reports=site_reports, totals=totals,
+                           history={'dates': dates, 'sites': series})
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,281 @@
+"""Retention and roll-up compaction for old count snapshots.
+
+Recent snapshots (``DD-MM-YYYY_contagem.xlsx``) are kept as they are. Older
+ones are thinned to the last count of each week and, further back, of each
+month; the kept counts are written as compact rows (Data, Grupo, Produto,
+TOTAL) into one roll-up file per year under ``historico/`` and the original
+spreadsheets are moved to ``arquivo/``.
+
+Run it periodically (e.g. from cron); every site is compacted unless
+``--site`` is given:
+
+    python v2_flask/compaction.py --daily-days 90 --weekly-days 365
+"""
+import argparse
+import glob
+import logging
+import os
+from contextlib import ExitStack
+from datetime import datetime
+
+import pandas as pd
+
+from sites import DATA_DIR, get_archive_dir, get_rollup_dir, get_site_dir, is_valid_site, list_sites
+from storage import bump_version, data_lock, replace_atomically, snapshot_lock
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_COLUMNS = ['Data', 'Periodo', 'Grupo', 'Produto', 'TOTAL']
+
+# Snapshot locks held at once while moving files to the archive
+ARCHIVE_BATCH_SIZE = 50
+
+DEFAULT_DAILY_DAYS = int(os.environ.get('DAILY_RETENTION_DAYS', 90))
+DEFAULT_WEEKLY_DAYS = int(os.environ.get('WEEKLY_RETENTION_DAYS', 365))
+
+
+def parse_snapshot_date(filename):
+    """Return the date of a ``DD-MM-YYYY_contagem.xlsx`` file name, or None."""
+    try:
+        return datetime.strptime(os.path.basename(filename).split('_')[0], '%d-%m-%Y')
+    except ValueError:
+        return None
+
+
+def period_for(date_obj, today, daily_days, weekly_days):
+    """Return (period name, bucket key) for a snapshot date under the policy."""
+    age = (today - date_obj).days
+    if age <= daily_days:
+        return 'diario', date_obj.strftime('%Y-%m-%d')
+    if age <= weekly_days:
+        year, week, _ = date_obj.isocalendar()
+        return 'semanal', f'{year}-W{week:02d}'
+    return 'mensal', date_obj.strftime('%Y-%m')
+
+
+def read_rollups(data_dir):
+    """Read every roll-up file into one DataFrame (Data parsed as datetime)."""
+    frames = []
+    for f in sorted(glob.glob(os.path.join(get_rollup_dir(data_dir), '*_historico.csv'))):
+        df = pd.read_csv(f)
+        if not df.empty:
+            frames.append(df)
+    if not frames:
+        return pd.DataFrame(columns=ROLLUP_COLUMNS)
+    df = pd.concat(frames, ignore_index=True)
+    df['Data'] = pd.to_datetime(df['Data'], format='%d-%m-%Y')
+    df['TOTAL'] = pd.to_numeric(df['TOTAL'], errors='coerce').fillna(0)
+    return df
+
+
+def load_rollup_points(data_dir):
+    """Return roll-up rows as history data points, one per rolled-up date.
+
+    Each point has the same shape as the ones built from live snapshots:
+    ``date``, ``date_str``, ``groups`` (group totals) and ``products``
+    (``(Produto, Grupo) -> TOTAL``).
+    """
+    df = read_rollups(data_dir)
+    data_points = []
+    for date_obj, day_df in df.groupby('Data'):
+        date_obj = date_obj.to_pydatetime()
+        products = {}
+        for p, g, t in zip(day_df['Produto'].tolist(), day_df['Grupo'].tolist(), day_df['TOTAL'].tolist()):
+            products[(p, g)] = t
+        data_points.append({
+            'date': date_obj,
+            'date_str': date_obj.strftime('%d-%m-%Y'),
+            'groups': day_df.groupby('Grupo')['TOTAL'].sum().to_dict(),
+            'products': products
+        })
+    return data_points
+
+
+def read_snapshot_rows(file_path, date_obj):
+    """Read the compact roll-up rows of a single snapshot file."""
+    df = pd.read_excel(file_path)
+    if 'Produto' not in df.columns or 'Grupo' not in df.columns:
+        return pd.DataFrame(columns=ROLLUP_COLUMNS)
+    df = df.copy()
+    df['TOTAL'] = pd.to_numeric(df['TOTAL'], errors='coerce').fillna(0) if 'TOTAL' in df.columns else 0
+    df['Data'] = date_obj
+    return df[['Data', 'Grupo', 'Produto', 'TOTAL']]
+
+
+def write_rollups(data_dir, df):
+    """Rewrite the per-year roll-up files from ``df``."""
+    rollup_dir = get_rollup_dir(data_dir)
+    os.makedirs(rollup_dir, exist_ok=True)
+
+    years = set(df['Data'].dt.year) if not df.empty else set()
+    for f in glob.glob(os.path.join(rollup_dir, '*_historico.csv')):
+        year = os.path.basename(f).split('_')[0]
+        if not year.isdigit() or int(year) not in years:
+            os.remove(f)
+
+    for year, year_df in df.groupby(df['Data'].dt.year):
+        out = year_df.sort_values(['Data', 'Grupo', 'Produto']).copy()
+        out['Data'] = out['Data'].dt.strftime('%d-%m-%Y')
+        path = os.path.join(rollup_dir, f'{year}_historico.csv')
+        replace_atomically(path, lambda fh: out[ROLLUP_COLUMNS].to_csv(fh, index=False))
+
+
+def compact(data_dir=DATA_DIR, daily_days=DEFAULT_DAILY_DAYS, weekly_days=DEFAULT_WEEKLY_DAYS,
+            today=None, dry_run=False):
+    """Apply the retention policy to ``data_dir``.
+
+    Returns a summary dict with the archived file names and the dates kept
+    in the roll-ups.
+    """
+    if weekly_days < daily_days:
+        raise ValueError('weekly_days must be greater than or equal to daily_days')
+    today = today or datetime.now()
+
+    # One run at a time per folder; the snapshots are listed under the lock
+    # so an overlapping run never works from a stale list
+    with data_lock(data_dir, 'compaction'):
+        # Snapshots that left the daily window
+        expired = []
+        for f in glob.glob(os.path.join(data_dir, '*_contagem.xlsx')):
+            date_obj = parse_snapshot_date(f)
+            if date_obj is None:
+                continue
+            if period_for(date_obj, today, daily_days, weekly_days)[0] != 'diario':
+                expired.append((date_obj, f))
+
+        return _compact_expired(data_dir, sorted(expired), today, daily_days, weekly_days, dry_run)
+
+
+def _file_identity(path):
+    """Return what changes when a snapshot is re-saved.
+
+    Saves rename a new file into place, so the inode changes even where the
+    filesystem's timestamps are too coarse to tell two saves apart.
+    """
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def _compact_expired(data_dir, expired, today, daily_days, weekly_days, dry_run):
+    # Unreadable snapshots stay where they are so nothing is archived unrolled;
+    # the file identity read is remembered to detect saves made after it
+    archivable = []
+    snapshot_frames = []
+    read_dates = []
+    for date_obj, f in expired:
+        try:
+            with snapshot_lock(data_dir, date_obj.strftime('%d-%m-%Y')):
+                identity = _file_identity(f)
+                snapshot_frames.append(read_snapshot_rows(f, date_obj))
+            archivable.append((f, identity))
+            read_dates.append(date_obj)
+        except Exception as e:
+            logger.warning('Ignorando %s: %s', os.path.basename(f), e)
+
+    # A snapshot that was read is authoritative over roll-up rows of the same
+    # date (left behind by an interrupted run or a skipped archive move);
+    # roll-up rows of skipped snapshots are kept as they are
+    rollups = read_rollups(data_dir)
+    old_rows = rollups[~rollups['Data'].isin(read_dates)] if not rollups.empty else rollups
+    frames = [old_rows[['Data', 'Grupo', 'Produto', 'TOTAL']]] if not old_rows.empty else []
+    frames += snapshot_frames
+
+    summary = {'archived': [], 'kept': []}
+
+    if frames:
+        df = pd.concat(frames, ignore_index=True)
+    else:
+        df = pd.DataFrame(columns=ROLLUP_COLUMNS)
+    df['Data'] = pd.to_datetime(df['Data'])
+
+    # Keep the last count of each bucket; rolled-up weeks keep thinning
+    # into months as they age
+    if not df.empty:
+        dates = sorted(df['Data'].dt.to_pydatetime().tolist())
+        kept = {}
+        periods = {}
+        for d in dates:
+            period, bucket = period_for(d, today, daily_days, weekly_days)
+            kept[bucket] = d
+            periods[d] = period
+        kept_dates = set(kept.values())
+        df = df[df['Data'].isin(kept_dates)]
+        # Sum repeated rows (as the live history does for group totals)
+        # instead of dropping them
+        df = df.groupby(['Data', 'Grupo', 'Produto'], dropna=False)['TOTAL'].sum().reset_index()
+        df['Periodo'] = df['Data'].map(lambda d: periods[d.to_pydatetime()])
+        summary['kept'] = [d.strftime('%d-%m-%Y') for d in sorted(kept_dates)]
+
+    if dry_run:
+        summary['archived'] = [os.path.basename(f) for f, _ in archivable]
+        return summary
+
+    # Nothing to do: leave the roll-ups and the data version untouched so
+    # the readers' caches stay valid
+    if not archivable:
+        previous = set(zip(rollups['Data'], rollups['Periodo'])) if not rollups.empty else set()
+        current = set(zip(df['Data'], df['Periodo'])) if not df.empty else set()
+        if previous == current:
+            return summary
+
+    # Roll-ups are written before the originals move, so an interrupted run
+    # never loses a count
+    write_rollups(data_dir, df)
+
+    archive_dir = get_archive_dir(data_dir)
+    os.makedirs(archive_dir, exist_ok=True)
+    for start in range(0, len(archivable), ARCHIVE_BATCH_SIZE):
+        batch = archivable[start:start + ARCHIVE_BATCH_SIZE]
+        # The batch's date locks are held from the identity check through the
+        # version bump, so the manifest changes in the same step as the files
+        with ExitStack() as stack:
+            for f, _ in batch:
+                stack.enter_context(snapshot_lock(data_dir, os.path.basename(f).split('_')[0]))
+
+            archived_dates = []
+            for f, identity in batch:
+                filename = os.path.basename(f)
+                if _file_identity(f) != identity:
+                    # Re-saved after it was read: stays live (and wins over its
+                    # roll-up rows) until the next run
+                    logger.warning('Mantendo %s: alterado durante a compactação', filename)
+                    continue
+                os.replace(f, os.path.join(archive_dir, filename))
+                archived_dates.append(filename.split('_')[0])
+                summary['archived'].append(filename)
+            if archived_dates:
+                bump_version(data_dir, removed=archived_dates)
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compacta contagens antigas em arquivos de histórico.')
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--site', help='compacta apenas este local (padrão: todos)')
+    parser.add_argument('--daily-days', type=int, default=DEFAULT_DAILY_DAYS,
+                        help='dias mantendo todas as contagens (padrão: %(default)s)')
+    parser.add_argument('--weekly-days', type=int, default=DEFAULT_WEEKLY_DAYS,
+                        help='dias mantendo a última contagem de cada semana; depois, de cada mês (padrão: %(default)s)')
+    parser.add_argument('--dry-run', action='store_true', help='apenas mostra o que seria feito')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if args.weekly_days < args.daily_days:
+        parser.error('--weekly-days deve ser maior ou igual a --daily-days')
+    if args.site and not is_valid_site(args.site, args.data_dir):
+        parser.error(f'local desconhecido: {args.site} (disponíveis: {", ".join(list_sites(args.data_dir))})')
+
+    sites = [args.site] if args.site else list_sites(args.data_dir)
+    for site in sites:
+        site_dir = get_site_dir(site, args.data_dir)
+        summary = compact(site_dir, args.daily_days, args.weekly_days, dry_run=args.dry_run)
+        print(f'[{site}]')
+        print(f"Arquivos arquivados: {len(summary['archived'])}")
+        for name in summary['archived']:
+            print(f'  {name}')
+        print(f"Datas no histórico compactado: {len(summary['kept'])}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Site (stock location) partitions of the data directory.
+
+The default site keeps using ``data/`` itself, so existing installations
+need no migration. Every other site is a folder under ``data/locais/`` with
+its own ``Base_estoque.xlsx``, count snapshots, roll-ups and archive.
+"""
+import os
+import re
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, '../data')
+
+DEFAULT_SITE = 'principal'
+SITES_DIR_NAME = 'locais'
+
+# Folders the compaction job keeps inside each site folder
+ROLLUP_DIR_NAME = 'historico'
+ARCHIVE_DIR_NAME = 'arquivo'
+
+_SITE_NAME_RE = re.compile(r'^[\w-]+$')
+
+
+def list_sites(data_dir=DATA_DIR):
+    """Return the default site followed by the site folders, sorted by name."""
+    sites_dir = os.path.join(data_dir, SITES_DIR_NAME)
+    sites = []
+    if os.path.isdir(sites_dir):
+        for name in sorted(os.listdir(sites_dir)):
+            if name != DEFAULT_SITE and _SITE_NAME_RE.match(name) and os.path.isdir(os.path.join(sites_dir, name)):
+                sites.append(name)
+    return [DEFAULT_SITE] + sites
+
+
+def is_valid_site(site, data_dir=DATA_DIR):
+    return bool(site) and _SITE_NAME_RE.match(site) is not None and site in list_sites(data_dir)
+
+
+def get_site_dir(site=DEFAULT_SITE, data_dir=DATA_DIR):
+    """Return the data folder of ``site``; raises ValueError for unknown sites."""
+    if site == DEFAULT_SITE:
+        return data_dir
+    if not is_valid_site(site, data_dir):
+        raise ValueError(f'Local desconhecido: {site}')
+    return os.path.join(data_dir, SITES_DIR_NAME, site)
+
+
+def get_rollup_dir(site_dir):
+    return os.path.join(site_dir, ROLLUP_DIR_NAME)
+
+
+def get_archive_dir(site_dir):
+    return os.path.join(site_dir, ARCHIVE_DIR_NAME)
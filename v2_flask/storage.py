@@ -0,0 +1,121 @@
+"""Atomic, lock-protected writes of count snapshots.
+
+A save writes the spreadsheet to a temporary file in the same folder and
+renames it over ``DD-MM-YYYY_contagem.xlsx``, so readers only ever see the
+previous or the new complete file. Saves of the same date are serialized by
+a file lock in ``.locks/`` (shared by every worker process), and each save
+bumps the folder's ``.manifest.json`` version before the lock is released;
+readers use that version to tell whether their cached view is current.
+"""
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: locks only cover threads of this process
+    fcntl = None
+
+LOCKS_DIR_NAME = '.locks'
+MANIFEST_NAME = '.manifest.json'
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+def _lock_path(data_dir, name):
+    locks_dir = os.path.join(data_dir, LOCKS_DIR_NAME)
+    os.makedirs(locks_dir, exist_ok=True)
+    return os.path.join(locks_dir, f'{name}.lock')
+
+
+@contextmanager
+def _file_lock(path):
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(path, threading.Lock())
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        with open(path, 'a') as fh:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def data_lock(data_dir, name):
+    """Hold the exclusive, cross-process lock ``name`` of a data folder."""
+    with _file_lock(_lock_path(data_dir, name)):
+        yield
+
+
+def snapshot_lock(data_dir, date_str):
+    """Hold the exclusive lock of one snapshot date (``DD-MM-YYYY``)."""
+    return data_lock(data_dir, date_str)
+
+
+def replace_atomically(path, write):
+    """Call ``write(fh)`` on a temp file next to ``path`` and rename it over ``path``."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            write(fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        # mkstemp creates the file readable by the owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_manifest(data_dir):
+    """Return the folder's manifest (``version`` and per-date ``snapshots``)."""
+    try:
+        with open(os.path.join(data_dir, MANIFEST_NAME), encoding='utf-8') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {'version': 0, 'snapshots': {}}
+
+
+def get_data_version(data_dir):
+    return read_manifest(data_dir).get('version', 0)
+
+
+def bump_version(data_dir, saved=(), removed=()):
+    """Record saved/removed snapshot dates and increment the folder version.
+
+    Callers hold the lock of every date they pass, so the manifest changes
+    in the same step as the files it describes.
+    """
+    with _file_lock(_lock_path(data_dir, 'manifest')):
+        manifest = read_manifest(data_dir)
+        version = manifest.get('version', 0) + 1
+        snapshots = manifest.get('snapshots', {})
+        for date_str in saved:
+            snapshots[date_str] = {'version': version, 'saved_at': datetime.now().isoformat(timespec='seconds')}
+        for date_str in removed:
+            snapshots.pop(date_str, None)
+        manifest = {'version': version, 'snapshots': snapshots}
+
+        payload = json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8')
+        replace_atomically(os.path.join(data_dir, MANIFEST_NAME), lambda fh: fh.write(payload))
+        return version
+
+
+def write_snapshot(data_dir, date_str, df):
+    """Atomically save ``df`` as the ``date_str`` snapshot; returns the file path and new version."""
+    file_path = os.path.join(data_dir, f'{date_str}_contagem.xlsx')
+    with snapshot_lock(data_dir, date_str):
+        replace_atomically(file_path, lambda fh: df.to_excel(fh, index=False, engine='openpyxl'))
+        version = bump_version(data_dir, saved=[date_str])
+    return file_path, version